@@ -4,6 +4,13 @@ import openpyxl
 from io import BytesIO
 import zipfile
 import re
+import difflib
+import os
+import posixpath
+import xml.etree.ElementTree as ET
+import shutil
+import tempfile
+import weakref
 from datetime import datetime
 
 # 页面配置
@@ -103,10 +110,698 @@ with st.sidebar:
     st.header("⚠️ 注意事项")
     st.warning("""
     - FSE原始数据表必须包含: Notes, Lead Name, Lead Status, Leads Created On
-    - 员工mapping表必须包含: NameEN, JobTitle, EmailAddress, 八大区, 29小区
+    - 员工mapping表必须包含: NameEN, JobTitle, EmailAddress, Manager, 八大区, 29小区
+    - 上传文件会先校验表头，缺少必需列时会直接提示
     - 派工员的八大区和29小区可能为空，这是正常现象
     """)
 
+# 必需列定义（用于读取前的表头校验）
+FSE_REQUIRED_COLUMNS = ['Notes', 'Lead Name', 'Lead Status', 'Leads Created On']
+MAPPING_REQUIRED_COLUMNS = ['NameEN', 'JobTitle', 'EmailAddress', 'Manager', '八大区', '29小区']
+
+# 区域分组排名中每个分组（月份 × 八大区）保留的前K名小区
+AREA_TOP_K = 3
+
+
+def _local_name(tag):
+    """去掉XML命名空间前缀"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _resolve_rels(zf, rels_path, base_dir):
+    """读取 .rels 文件，返回 {关系Id: (类型, 包内路径)}"""
+    rels = {}
+    for rel in ET.fromstring(zf.read(rels_path)):
+        target = rel.get('Target', '')
+        if target.startswith('/'):
+            path = target.lstrip('/')
+        else:
+            path = posixpath.normpath(posixpath.join(base_dir, target))
+        rels[rel.get('Id')] = (rel.get('Type', ''), path)
+    return rels
+
+
+def _read_shared_strings(zf, path, indices):
+    """流式读取共享字符串表，只解析表头用到的下标，取到最大下标后立即停止"""
+    wanted = set(indices)
+    last = max(wanted)
+    strings = {}
+    index = -1
+    for _, elem in ET.iterparse(zf.open(path), events=('end',)):
+        if _local_name(elem.tag) != 'si':
+            continue
+        index += 1
+        if index in wanted:
+            # 富文本由多个<r><t>组成；<rPh>是注音，不属于单元格文本
+            parts = []
+            for child in elem:
+                name = _local_name(child.tag)
+                if name == 't':
+                    parts.append(child.text or '')
+                elif name == 'r':
+                    parts.extend(t.text or '' for t in child if _local_name(t.tag) == 't')
+            strings[index] = ''.join(parts)
+        elem.clear()
+        if index >= last:
+            break
+    return strings
+
+
+def read_header_row(uploaded_file):
+    """流式读取第一个工作表中第一行非空行，返回 (该行的0起始行号, 表头列表)"""
+    with zipfile.ZipFile(uploaded_file) as zf:
+        # 通过包关系定位工作簿主文件，不假设其固定在 xl/workbook.xml
+        workbook_path = next(
+            (path for rel_type, path in _resolve_rels(zf, '_rels/.rels', '').values() if rel_type.endswith('/officeDocument')),
+            None
+        )
+        if workbook_path is None:
+            raise ValueError("文件中未找到工作簿主文件（不是有效的xlsx文件）")
+        workbook_dir, workbook_name = posixpath.split(workbook_path)
+        workbook_rels = _resolve_rels(zf, posixpath.join(workbook_dir, '_rels', workbook_name + '.rels'), workbook_dir)
+        
+        # 与 pd.read_excel(sheet_name=0) 一致：取第一个工作表，跳过图表页等非工作表
+        sheets = next((e for e in ET.fromstring(zf.read(workbook_path)) if _local_name(e.tag) == 'sheets'), [])
+        sheet_path = None
+        for sheet in sheets:
+            rel_id = next((v for k, v in sheet.attrib.items() if _local_name(k) == 'id'), None)
+            rel_type, path = workbook_rels.get(rel_id, ('', None))
+            if rel_type.endswith('/worksheet'):
+                sheet_path = path
+                break
+        if sheet_path is None:
+            raise ValueError("工作簿中没有工作表")
+        shared_strings_path = next(
+            (path for rel_type, path in workbook_rels.values() if rel_type.endswith('/sharedStrings')),
+            None
+        )
+        
+        # 逐行解析工作表XML，遇到第一行非空行即停止，不读取其余数据
+        cells = []
+        row_number = 0
+        for _, elem in ET.iterparse(zf.open(sheet_path), events=('end',)):
+            if _local_name(elem.tag) != 'row':
+                continue
+            # 空行可能不写入XML，行号以r属性为准
+            row_number = int(elem.get('r', row_number + 1))
+            cells = []
+            for c in elem:
+                if _local_name(c.tag) != 'c':
+                    continue
+                cell_type = c.get('t')
+                value = None
+                for child in c:
+                    name = _local_name(child.tag)
+                    if name == 'v':
+                        value = child.text
+                    elif name == 'is':
+                        value = ''.join(t.text or '' for t in child.iter() if _local_name(t.tag) == 't')
+                cells.append((cell_type, value))
+            elem.clear()
+            if any(value not in (None, '') for _, value in cells):
+                break
+        
+        # 只解析表头引用到的共享字符串
+        shared_indices = [int(value) for cell_type, value in cells if cell_type == 's' and value is not None]
+        shared = _read_shared_strings(zf, shared_strings_path, shared_indices) if shared_indices and shared_strings_path else {}
+    
+    headers = []
+    for cell_type, value in cells:
+        if value in (None, ''):
+            continue
+        headers.append(shared.get(int(value), '') if cell_type == 's' else value)
+    return max(row_number - 1, 0), headers
+
+
+def validate_headers(uploaded_file, required_columns, file_label):
+    """只读取第一个工作表的表头行，返回 (表头行号, 缺失列的错误信息列表)；错误列表为空表示校验通过"""
+    try:
+        header_row, headers = read_header_row(uploaded_file)
+    except Exception as e:
+        return 0, [f"❌ {file_label} 无法读取: {str(e)}"]
+    finally:
+        # 复位文件指针，供后续 pd.read_excel 完整读取
+        uploaded_file.seek(0)
+    
+    # 用于查找相近列名（忽略大小写和首尾空格）
+    normalized = {h.strip().lower(): h for h in headers}
+    errors = []
+    for col in required_columns:
+        if col in headers:
+            continue
+        suggestions = [normalized[m] for m in difflib.get_close_matches(col.lower(), normalized.keys(), n=3, cutoff=0.6)]
+        if suggestions:
+            errors.append(f"❌ {file_label} 缺少列 `{col}`，是否为: " + ", ".join(f"`{h}`" for h in suggestions) + "？")
+        else:
+            errors.append(f"❌ {file_label} 缺少列 `{col}`")
+    return header_row, errors
+
+
+# 结果表定义（结果视图、下载文件名及工作表、ZIP打包共用）
+RESULT_TABLES = {
+    'engineer': {
+        'tab': '👷 工程师奖金表',
+        'title': '工程师奖金明细',
+        'unit': '条记录',
+        'label': '📥 下载工程师奖金表',
+        'file_name': '工程师奖金表.xlsx',
+        'sheets': {'工程师奖金': 'engineer'},
+        'empty': '暂无工程师奖金数据',
+    },
+    'planner': {
+        'tab': '📋 派工员奖金表',
+        'title': '派工员奖金明细',
+        'unit': '条记录',
+        'label': '📥 下载派工员奖金表',
+        'file_name': '派工员奖金表.xlsx',
+        'sheets': {'派工员奖金': 'planner'},
+        'empty': '暂无派工员奖金数据',
+    },
+    'area_rank': {
+        'tab': '🏆 区域排名奖金',
+        'title': '区域排名奖金明细',
+        'unit': '个小区',
+        'label': '📥 下载区域排名奖金表',
+        'file_name': '区域排名奖金.xlsx',
+        'sheets': {'区域排名': 'area_rank', '分组排名': 'area_group_rank'},
+        'empty': '暂无区域排名数据',
+    },
+    'pipeline': {
+        'tab': '🔧 后处理奖金',
+        'title': '后处理奖金明细',
+        'unit': '条记录',
+        'label': '📥 下载后处理奖金表',
+        'file_name': '后处理奖金.xlsx',
+        'sheets': {'后处理奖金': 'pipeline'},
+        'empty': '暂无后处理奖金数据',
+    },
+    'fse': {
+        'tab': '📊 原始数据',
+        'title': '处理后的原始数据',
+        'unit': '条记录',
+        'label': '📥 下载完整原始数据',
+        'file_name': 'FSE原始数据表_处理后.xlsx',
+        'sheets': {'原始数据': 'fse'},
+        'empty': '暂无原始数据',
+    },
+}
+
+# 原始数据页预览的新增字段
+RAW_PREVIEW_COLUMNS = ['员工名', 'JobTitle', 'Manager', '八大区', '29小区', '商机类型', '包含管道过滤器']
+
+
+def build_excel_bytes(sheets):
+    """将 {工作表名: DataFrame} 写入一个xlsx工作簿，返回文件字节"""
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return buffer.getvalue()
+
+
+# 每个会话保存计算结果的内存预算（MB），可通过环境变量调整
+SESSION_MEMORY_BUDGET_MB = float(os.environ.get('FSE_SESSION_MEMORY_BUDGET_MB', '200'))
+
+
+class SessionResultStore:
+    """会话级结果存储：超出内存预算时按最近最少使用（LRU）顺序将数据写入临时文件，访问时再按需加载"""
+    
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._memory = {}       # key -> 内存中的对象
+        self._sizes = {}        # key -> 内存占用（字节）
+        self._paths = {}        # key -> 已写入磁盘的文件路径
+        self._last_access = {}  # key -> 最近一次访问的序号（跨页面运行递增）
+        self._clock = 0
+        self._file_count = 0
+        self._tmpdir = tempfile.mkdtemp(prefix='fse_session_')
+        # 会话结束（对象被回收）或进程退出时删除临时文件
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self._tmpdir, True)
+    
+    @staticmethod
+    def _size_of(value):
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True, deep=True).sum())
+        return len(value)
+    
+    def __contains__(self, key):
+        return key in self._memory or key in self._paths
+    
+    def _touch(self, key):
+        self._clock += 1
+        self._last_access[key] = self._clock
+    
+    def put(self, key, value):
+        self._memory[key] = value
+        self._sizes[key] = self._size_of(value)
+        self._paths.pop(key, None)
+        self._touch(key)
+        self._enforce_budget()
+    
+    def get(self, key):
+        self._touch(key)
+        value = self._memory.get(key)
+        if value is None:
+            # 从磁盘加载已转存的数据
+            path = self._paths[key]
+            if path.endswith('.parquet'):
+                value = pd.read_parquet(path)
+            elif path.endswith('.pkl'):
+                value = pd.read_pickle(path)
+            else:
+                with open(path, 'rb') as f:
+                    value = f.read()
+            self._memory[key] = value
+            # Parquet读回后数据类型可能变化，重新计算内存占用
+            self._sizes[key] = self._size_of(value)
+            self._enforce_budget()
+        # 返回局部引用：单项超出预算时存储本身已不再持有它，由调用方用完即释放
+        return value
+    
+    def memory_usage(self):
+        return sum(self._sizes[key] for key in self._memory)
+    
+    def spilled_count(self):
+        return sum(1 for key in self._paths if key not in self._memory)
+    
+    def _spill(self, key):
+        value = self._memory.pop(key)
+        if key in self._paths:
+            # 数据不可变，已有的磁盘文件可直接复用
+            return
+        self._file_count += 1
+        base = os.path.join(self._tmpdir, str(self._file_count))
+        if isinstance(value, pd.DataFrame):
+            path = base + '.parquet'
+            try:
+                value.to_parquet(path, index=False)
+            except Exception:
+                # 混合类型的object列无法写入Parquet时退回pickle
+                path = base + '.pkl'
+                value.to_pickle(path)
+        else:
+            # 工作簿/ZIP字节按原格式写入
+            path = base + os.path.splitext(key)[1]
+            with open(path, 'wb') as f:
+                f.write(value)
+        self._paths[key] = path
+    
+    def _enforce_budget(self):
+        # 按最近最少使用的顺序转存，直到回到预算以内；刚访问的数据排在最后，
+        # 但单项本身超出预算时也会转存，不会常驻内存
+        candidates = sorted(self._memory, key=lambda key: self._last_access[key])
+        for key in candidates:
+            if self.memory_usage() <= self.budget_bytes:
+                break
+            self._spill(key)
+    
+    def close(self):
+        """立即释放内存并删除临时文件"""
+        self._memory.clear()
+        self._finalizer()
+
+
+def clear_results():
+    """清除会话中保存的计算结果"""
+    results = st.session_state.pop('results', None)
+    if results is not None:
+        results['store'].close()
+
+
+def run_calculation(fse_file, mapping_file, fse_header_row, mapping_header_row, source_files, progress_bar, status_text):
+    """执行完整的奖金计算流程，返回保存到会话中的结果（中间数据均为局部变量，返回后即释放）"""
+    # ==================== Step 1: 读取数据 ====================
+    status_text.text("📖 步骤 1/7: 正在读取数据...")
+    progress_bar.progress(5)
+    
+    # 按预检找到的表头行读取（跳过表头前的空行）
+    df_fse = pd.read_excel(fse_file, header=fse_header_row)
+    df_mapping = pd.read_excel(mapping_file, header=mapping_header_row)
+    
+    # 修复日期解析：将Excel日期数字转换为标准日期
+    # Excel使用1899-12-30作为基准日期，天数从1开始
+    if pd.api.types.is_numeric_dtype(df_fse['Leads Created On']):
+        df_fse['Leads Created On'] = pd.to_datetime('1899-12-30') + pd.to_timedelta(df_fse['Leads Created On'], unit='D')
+    else:
+        df_fse['Leads Created On'] = pd.to_datetime(df_fse['Leads Created On'], errors='coerce')
+    
+    status_text.text("✅ 数据读取成功！")
+    status_text.text(f"   FSE原始数据: {len(df_fse)} 条记录")
+    status_text.text(f"   员工mapping: {len(df_mapping)} 条记录")
+    
+    progress_bar.progress(15)
+    
+    # ==================== Step 2: 员工名提取与匹配 ====================
+    status_text.text("🔍 步骤 2/7: 正在进行员工名提取与匹配...")
+    progress_bar.progress(20)
+    
+    # 定义提取员工名的函数（修复正则表达式，匹配实际格式）
+    def extract_employee_name(note):
+        if pd.isna(note):
+            return None
+        
+        note_str = str(note)
+        
+        # 优先尝试邮箱格式
+        email_match = re.search(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', note_str)
+        if email_match:
+            email = email_match.group(1).lower().strip()
+            # 在mapping表中查找邮箱
+            matching_row = df_mapping[df_mapping['EmailAddress'].str.lower() == email]
+            if not matching_row.empty:
+                return matching_row.iloc[0]['NameEN']
+        
+        # 修复：尝试工号+姓名格式（工号包含字母和数字混合）
+        # 实际格式如：CN90AF27, CN90A325, CN90AE03 等
+        # 模式说明：CN + 数字 + 可能的字母/数字 + 可能的字母/数字 + "-" + 姓名
+        name_match = re.search(r'[A-Z]{2}\d+[A-Z0-9]{0,2}\s*-\s*([A-Za-z\s]+)', note_str)
+        if name_match:
+            name = name_match.group(1).strip()
+            # 标准化姓名格式（首字母大写）
+            name = ' '.join([word.capitalize() for word in name.split()])
+            return name
+        
+        return None
+    
+    # 提取员工名
+    df_fse['员工名'] = df_fse['Notes'].apply(extract_employee_name)
+    
+    # 统计匹配成功率
+    matched_count = df_fse['员工名'].notna().sum()
+    match_rate = (matched_count / len(df_fse)) * 100 if len(df_fse) > 0 else 0
+    
+    status_text.text(f"✅ 员工名提取完成！匹配率: {match_rate:.1f}% ({matched_count}/{len(df_fse)})")
+    progress_bar.progress(30)
+    
+    # ==================== Step 3: 区域与职责信息匹配 ====================
+    status_text.text("🗺️ 步骤 3/7: 正在进行区域与职责信息匹配...")
+    progress_bar.progress(35)
+    
+    # 创建mapping字典
+    name_to_info = df_mapping.set_index('NameEN')[['Manager', 'JobTitle', '八大区', '29小区']].to_dict('index')
+    
+    # 匹配区域和职责信息
+    df_fse['Manager'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('Manager') if pd.notna(x) else None)
+    df_fse['JobTitle'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('JobTitle') if pd.notna(x) else None)
+    df_fse['八大区'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('八大区') if pd.notna(x) else None)
+    df_fse['29小区'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('29小区') if pd.notna(x) else None)
+    
+    status_text.text("✅ 区域与职责信息匹配完成！")
+    progress_bar.progress(45)
+    
+    # ==================== Step 4: 商机类型识别 ====================
+    status_text.text("🏷️ 步骤 4/7: 正在进行商机类型识别...")
+    progress_bar.progress(50)
+    
+    # 提取商机类型函数：取第二个"-"与第三个"-"之间的内容
+    def extract_opportunity_type(lead_name):
+        if pd.isna(lead_name):
+            return None
+        
+        lead_name_str = str(lead_name)
+        parts = lead_name_str.split('-')
+        
+        if len(parts) >= 3:
+            # 取第3个元素（索引2）
+            return parts[2].strip()
+        
+        return None
+    
+    df_fse['商机类型'] = df_fse['Lead Name'].apply(extract_opportunity_type)
+    
+    status_text.text("✅ 商机类型识别完成！")
+    progress_bar.progress(55)
+    
+    # ==================== Step 5: 工程师奖金计算 ====================
+    status_text.text("👷 步骤 5/7: 正在计算工程师奖金...")
+    progress_bar.progress(60)
+    
+    # 定义工程师职位列表
+    engineer_titles = [
+        'Service Supervisor',
+        'Service Engineer',
+        'Service Manager',
+        'Service Supervisor-Marine',
+        'Senior Service Engineer'
+    ]
+    
+    # 定义目标转化商机类型
+    target_opportunities = [
+        'ABB变频器',
+        'FP转子大修商机',
+        'MAM2 Element Exchange/D Visit/E Visit',
+        'MAM2 Optimization+Upgrades',
+        '转子大修商机',
+        '高级产品商机',
+        '集控产品'
+    ]
+    
+    # 筛选工程师数据
+    df_engineer = df_fse[df_fse['JobTitle'].isin(engineer_titles)].copy()
+    
+    if len(df_engineer) > 0:
+        # 提取月份（日期已在Step 1中修复为正确格式）
+        df_engineer['月份'] = df_engineer['Leads Created On'].dt.to_period('M').astype(str)
+        
+        # 计算提交个数
+        submit_count = df_engineer.groupby(['八大区', '29小区', 'JobTitle', '员工名', '月份']).size().reset_index(name='提交个数')
+        
+        # 计算转化个数
+        df_engineer_converted = df_engineer[
+            (df_engineer['Lead Status'] == 'converted') &
+            (df_engineer['商机类型'].isin(target_opportunities))
+        ]
+        
+        convert_count = df_engineer_converted.groupby(['八大区', '29小区', 'JobTitle', '员工名', '月份']).size().reset_index(name='转化个数')
+        
+        # 合并提交和转化数据
+        df_engineer_bonus = pd.merge(submit_count, convert_count, on=['八大区', '29小区', 'JobTitle', '员工名', '月份'], how='left')
+        df_engineer_bonus['转化个数'] = df_engineer_bonus['转化个数'].fillna(0)
+        
+        # 计算当月奖金
+        df_engineer_bonus['当月奖金'] = df_engineer_bonus['提交个数'] * 20 + df_engineer_bonus['转化个数'] * 100
+        
+        # 按原始列顺序排列
+        df_engineer_bonus = df_engineer_bonus[['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金']]
+        
+        engineer_count = df_engineer_bonus['员工名'].nunique()
+        engineer_submit_total = df_engineer_bonus['提交个数'].sum()
+        engineer_convert_total = df_engineer_bonus['转化个数'].sum()
+        engineer_bonus_total = df_engineer_bonus['当月奖金'].sum()
+    else:
+        df_engineer_bonus = pd.DataFrame(columns=['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金'])
+        engineer_count = 0
+        engineer_submit_total = 0
+        engineer_convert_total = 0
+        engineer_bonus_total = 0
+    
+    status_text.text(f"✅ 工程师奖金计算完成！共 {engineer_count} 名工程师")
+    progress_bar.progress(70)
+    
+    # ==================== Step 6: 区域排名奖金计算 ====================
+    status_text.text("🏆 步骤 6/7: 正在计算区域排名奖金...")
+    progress_bar.progress(75)
+    
+    # 按29小区统计
+    df_area_stats = df_engineer_bonus.groupby('29小区').agg({
+        '提交个数': 'sum',
+        '转化个数': 'sum',
+        '当月奖金': 'sum'
+    }).reset_index()
+    
+    # 获取每个小区对应的经理（同一小区多个经理时合并为一行，避免重复）
+    area_managers = (
+        df_engineer[['29小区', 'Manager']].dropna().astype({'Manager': str}).drop_duplicates()
+        .sort_values('Manager')
+        .groupby('29小区')['Manager'].agg('、'.join)
+        .reset_index()
+    )
+    
+    # 合并经理信息
+    df_area_rank = pd.merge(df_area_stats, area_managers, on='29小区', how='left')
+    
+    # 重命名列
+    df_area_rank.columns = ['29小区', '提交总数', '转化总数', '总奖金', '经理']
+    
+    # 按总奖金排序
+    df_area_rank = df_area_rank.sort_values('总奖金', ascending=False).reset_index(drop=True)
+    
+    # 分组排名：一次groupby完成所有（月份, 八大区）分区内的小区排名
+    group_keys = ['月份', '八大区']
+    df_group_stats = df_engineer_bonus.groupby(group_keys + ['29小区']).agg({
+        '提交个数': 'sum',
+        '转化个数': 'sum',
+        '当月奖金': 'sum'
+    }).reset_index()
+    
+    # 经理来自mapping表，与月份无关，直接复用每个小区的经理
+    df_area_group_rank = pd.merge(df_group_stats, area_managers, on='29小区', how='left')
+    df_area_group_rank.columns = ['月份', '八大区', '29小区', '提交总数', '转化总数', '总奖金', '经理']
+    
+    # 分区内密集排名（总奖金相同名次相同）
+    df_area_group_rank['排名'] = (
+        df_area_group_rank.groupby(group_keys)['总奖金']
+        .rank(method='dense', ascending=False)
+        .astype(int)
+    )
+    
+    # 只保留每个分区前K名
+    df_area_group_rank = (
+        df_area_group_rank[df_area_group_rank['排名'] <= AREA_TOP_K]
+        .sort_values(group_keys + ['排名', '29小区'])
+        .reset_index(drop=True)
+    )
+    df_area_group_rank = df_area_group_rank[['月份', '八大区', '排名', '29小区', '经理', '提交总数', '转化总数', '总奖金']]
+    
+    # 获取排名第一的小区
+    if len(df_area_rank) > 0:
+        top_area = df_area_rank.iloc[0]
+        top_area_name = top_area['29小区']
+        top_area_manager = top_area['经理']
+        top_area_bonus = top_area['总奖金']
+    else:
+        top_area_name = None
+        top_area_manager = None
+        top_area_bonus = 0
+    
+    status_text.text(f"✅ 区域排名奖金计算完成！奖金最高小区: {top_area_name}")
+    progress_bar.progress(85)
+    
+    # ==================== Step 7: 派工员奖金计算 ====================
+    status_text.text("📋 步骤 7/7: 正在计算派工员奖金...")
+    progress_bar.progress(90)
+    
+    # 定义派工员职位列表
+    planner_titles = [
+        'Planner',
+        'Senior Planner',
+        'Planning Manager',
+        'Planner - Cross Border',
+        'Service Planning Center Supervisor'
+    ]
+    
+    # 筛选派工员数据
+    df_planner = df_fse[df_fse['JobTitle'].isin(planner_titles)].copy()
+    
+    if len(df_planner) > 0:
+        # 提取月份（日期已在Step 1中修复为正确格式）
+        df_planner['月份'] = df_planner['Leads Created On'].dt.to_period('M').astype(str)
+        
+        # 灵活分组：只按JobTitle、员工名、月份分组（避免区域空值问题）
+        planner_submit = df_planner.groupby(['JobTitle', '员工名', '月份']).size().reset_index(name='提交个数')
+        
+        # 计算转化个数（与工程师相同的规则）
+        df_planner_converted = df_planner[
+            (df_planner['Lead Status'] == 'converted') &
+            (df_planner['商机类型'].isin(target_opportunities))
+        ]
+        
+        if len(df_planner_converted) > 0:
+            planner_convert = df_planner_converted.groupby(['JobTitle', '员工名', '月份']).size().reset_index(name='转化个数')
+            planner_submit = pd.merge(planner_submit, planner_convert, on=['JobTitle', '员工名', '月份'], how='left')
+        else:
+            planner_submit['转化个数'] = 0
+        
+        planner_submit['转化个数'] = planner_submit['转化个数'].fillna(0)
+        
+        # 计算当月奖金
+        planner_submit['当月奖金'] = planner_submit['提交个数'] * 20 + planner_submit['转化个数'] * 100
+        
+        # 从原始数据中获取区域信息（保留空值）
+        area_info = df_planner[['员工名', '八大区', '29小区']].drop_duplicates()
+        df_planner_bonus = planner_submit.merge(area_info, on='员工名', how='left')
+        
+        # 重排列顺序
+        df_planner_bonus = df_planner_bonus[['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金']]
+        
+        planner_count = df_planner_bonus['员工名'].nunique()
+        planner_submit_total = df_planner_bonus['提交个数'].sum()
+        planner_convert_total = df_planner_bonus['转化个数'].sum()
+        planner_bonus_total = df_planner_bonus['当月奖金'].sum()
+    else:
+        df_planner_bonus = pd.DataFrame(columns=['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金'])
+        planner_count = 0
+        planner_submit_total = 0
+        planner_convert_total = 0
+        planner_bonus_total = 0
+    
+    status_text.text(f"✅ 派工员奖金计算完成！共 {planner_count} 名派工员")
+    progress_bar.progress(95)
+    
+    # ==================== 后处理奖金计算 ====================
+    status_text.text("🔧 正在计算后处理奖金...")
+    
+    # 标记包含管道过滤器的记录
+    df_fse['包含管道过滤器'] = df_fse['Lead Name'].str.contains('管道过滤器', na=False) | df_fse['Notes'].str.contains('管道过滤器', na=False)
+    
+    # 筛选包含管道过滤器的记录
+    df_pipeline = df_fse[df_fse['包含管道过滤器']].copy()
+    
+    if len(df_pipeline) > 0:
+        # 处理空八大区为"未分配"
+        df_pipeline['八大区'] = df_pipeline['八大区'].fillna('未分配')
+        
+        # 确保日期列是datetime类型
+        df_pipeline['Leads Created On'] = pd.to_datetime(df_pipeline['Leads Created On'], errors='coerce')
+        
+        # 提取月份
+        df_pipeline['月份'] = df_pipeline['Leads Created On'].dt.to_period('M').astype(str)
+        
+        # 按八大区和月份统计
+        df_pipeline_bonus = df_pipeline.groupby(['八大区', '月份']).size().reset_index(name='提交个数')
+        
+        pipeline_count = len(df_pipeline)
+        pipeline_areas = df_pipeline['八大区'].nunique()
+    else:
+        df_pipeline_bonus = pd.DataFrame(columns=['八大区', '月份', '提交个数'])
+        pipeline_count = 0
+        pipeline_areas = 0
+    
+    status_text.text(f"✅ 后处理奖金计算完成！共 {pipeline_count} 条管道过滤器记录，涉及 {pipeline_areas} 个区域")
+    progress_bar.progress(100)
+    
+    # ==================== 保存结果 ====================
+    # 结果表放入会话存储，超出内存预算时自动转存到临时文件；
+    # 下载文件不在这里生成，用户点击“生成下载文件”时才生成
+    store = SessionResultStore(SESSION_MEMORY_BUDGET_MB * 1024 * 1024)
+    tables = {
+        'engineer': df_engineer_bonus,
+        'planner': df_planner_bonus,
+        'area_rank': df_area_rank,
+        'area_group_rank': df_area_group_rank,
+        'pipeline': df_pipeline_bonus,
+        'fse': df_fse,
+    }
+    for key, df in tables.items():
+        store.put(f'table/{key}', df)
+    
+    # 原始数据页只展示前100条，单独保存一份小的预览，避免展示时加载整个df_fse
+    preview_columns = [col for col in RAW_PREVIEW_COLUMNS if col in df_fse.columns]
+    store.put('table/fse_preview', df_fse[preview_columns].head(100))
+    
+    return {
+        'source_files': source_files,
+        'store': store,
+        'row_counts': {key: len(df) for key, df in tables.items()},
+        'stats': {
+            'engineer_count': engineer_count,
+            'engineer_submit_total': engineer_submit_total,
+            'engineer_convert_total': engineer_convert_total,
+            'engineer_bonus_total': engineer_bonus_total,
+            'planner_count': planner_count,
+            'planner_submit_total': planner_submit_total,
+            'planner_convert_total': planner_convert_total,
+            'planner_bonus_total': planner_bonus_total,
+            'top_area_name': top_area_name,
+            'top_area_manager': top_area_manager,
+            'top_area_bonus': top_area_bonus,
+            'pipeline_count': pipeline_count,
+            'pipeline_areas': pipeline_areas,
+            'calculated_on': datetime.now().strftime("%Y%m%d"),
+        },
+    }
+
+
 # 文件上传区域
 st.subheader("📂 文件上传")
 col1, col2 = st.columns(2)
@@ -133,570 +828,41 @@ with col2:
         )
         st.markdown('</div>', unsafe_allow_html=True)
 
+# 上传文件变更后，之前保存的计算结果失效
+current_files = tuple(f.file_id for f in (fse_file, mapping_file) if f is not None)
+if 'results' in st.session_state and st.session_state['results']['source_files'] != current_files:
+    clear_results()
+
 # 开始计算按钮
 st.markdown("---")
 if st.button("🚀 开始计算", type="primary", use_container_width=True):
+    # 表头预检：在完整解析前快速发现缺失列
+    header_errors = []
+    if fse_file and mapping_file:
+        fse_header_row, fse_header_errors = validate_headers(fse_file, FSE_REQUIRED_COLUMNS, "FSE原始数据表")
+        mapping_header_row, mapping_header_errors = validate_headers(mapping_file, MAPPING_REQUIRED_COLUMNS, "员工mapping表")
+        header_errors = fse_header_errors + mapping_header_errors
+    
     if not fse_file or not mapping_file:
         st.error("❌ 请先上传两个文件才能开始计算！")
+    elif header_errors:
+        for msg in header_errors:
+            st.error(msg)
+        st.warning("请修正上述列名后重新上传文件。")
     else:
+        # 重新计算前清除上一次的结果
+        clear_results()
+        
         # 显示进度条
         progress_bar = st.progress(0)
         status_text = st.empty()
         
         try:
-            # ==================== Step 1: 读取数据 ====================
-            status_text.text("📖 步骤 1/7: 正在读取数据...")
-            progress_bar.progress(5)
-            
-            df_fse = pd.read_excel(fse_file)
-            df_mapping = pd.read_excel(mapping_file)
-            
-            # 修复日期解析：将Excel日期数字转换为标准日期
-            # Excel使用1899-12-30作为基准日期，天数从1开始
-            if pd.api.types.is_numeric_dtype(df_fse['Leads Created On']):
-                df_fse['Leads Created On'] = pd.to_datetime('1899-12-30') + pd.to_timedelta(df_fse['Leads Created On'], unit='D')
-            else:
-                df_fse['Leads Created On'] = pd.to_datetime(df_fse['Leads Created On'], errors='coerce')
-            
-            status_text.text("✅ 数据读取成功！")
-            status_text.text(f"   FSE原始数据: {len(df_fse)} 条记录")
-            status_text.text(f"   员工mapping: {len(df_mapping)} 条记录")
-            
-            progress_bar.progress(15)
-            
-            # ==================== Step 2: 员工名提取与匹配 ====================
-            status_text.text("🔍 步骤 2/7: 正在进行员工名提取与匹配...")
-            progress_bar.progress(20)
-            
-            # 定义提取员工名的函数（修复正则表达式，匹配实际格式）
-            def extract_employee_name(note):
-                if pd.isna(note):
-                    return None
-                
-                note_str = str(note)
-                
-                # 优先尝试邮箱格式
-                email_match = re.search(r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', note_str)
-                if email_match:
-                    email = email_match.group(1).lower().strip()
-                    # 在mapping表中查找邮箱
-                    matching_row = df_mapping[df_mapping['EmailAddress'].str.lower() == email]
-                    if not matching_row.empty:
-                        return matching_row.iloc[0]['NameEN']
-                
-                # 修复：尝试工号+姓名格式（工号包含字母和数字混合）
-                # 实际格式如：CN90AF27, CN90A325, CN90AE03 等
-                # 模式说明：CN + 数字 + 可能的字母/数字 + 可能的字母/数字 + "-" + 姓名
-                name_match = re.search(r'[A-Z]{2}\d+[A-Z0-9]{0,2}\s*-\s*([A-Za-z\s]+)', note_str)
-                if name_match:
-                    name = name_match.group(1).strip()
-                    # 标准化姓名格式（首字母大写）
-                    name = ' '.join([word.capitalize() for word in name.split()])
-                    return name
-                
-                return None
-            
-            # 提取员工名
-            df_fse['员工名'] = df_fse['Notes'].apply(extract_employee_name)
-            
-            # 统计匹配成功率
-            matched_count = df_fse['员工名'].notna().sum()
-            match_rate = (matched_count / len(df_fse)) * 100 if len(df_fse) > 0 else 0
-            
-            status_text.text(f"✅ 员工名提取完成！匹配率: {match_rate:.1f}% ({matched_count}/{len(df_fse)})")
-            progress_bar.progress(30)
-            
-            # ==================== Step 3: 区域与职责信息匹配 ====================
-            status_text.text("🗺️ 步骤 3/7: 正在进行区域与职责信息匹配...")
-            progress_bar.progress(35)
-            
-            # 创建mapping字典
-            name_to_info = df_mapping.set_index('NameEN')[['Manager', 'JobTitle', '八大区', '29小区']].to_dict('index')
-            
-            # 匹配区域和职责信息
-            df_fse['Manager'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('Manager') if pd.notna(x) else None)
-            df_fse['JobTitle'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('JobTitle') if pd.notna(x) else None)
-            df_fse['八大区'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('八大区') if pd.notna(x) else None)
-            df_fse['29小区'] = df_fse['员工名'].map(lambda x: name_to_info.get(x, {}).get('29小区') if pd.notna(x) else None)
-            
-            status_text.text("✅ 区域与职责信息匹配完成！")
-            progress_bar.progress(45)
-            
-            # ==================== Step 4: 商机类型识别 ====================
-            status_text.text("🏷️ 步骤 4/7: 正在进行商机类型识别...")
-            progress_bar.progress(50)
-            
-            # 提取商机类型函数：取第二个"-"与第三个"-"之间的内容
-            def extract_opportunity_type(lead_name):
-                if pd.isna(lead_name):
-                    return None
-                
-                lead_name_str = str(lead_name)
-                parts = lead_name_str.split('-')
-                
-                if len(parts) >= 3:
-                    # 取第3个元素（索引2）
-                    return parts[2].strip()
-                
-                return None
-            
-            df_fse['商机类型'] = df_fse['Lead Name'].apply(extract_opportunity_type)
-            
-            status_text.text("✅ 商机类型识别完成！")
-            progress_bar.progress(55)
-            
-            # ==================== Step 5: 工程师奖金计算 ====================
-            status_text.text("👷 步骤 5/7: 正在计算工程师奖金...")
-            progress_bar.progress(60)
-            
-            # 定义工程师职位列表
-            engineer_titles = [
-                'Service Supervisor',
-                'Service Engineer',
-                'Service Manager',
-                'Service Supervisor-Marine',
-                'Senior Service Engineer'
-            ]
-            
-            # 定义目标转化商机类型
-            target_opportunities = [
-                'ABB变频器',
-                'FP转子大修商机',
-                'MAM2 Element Exchange/D Visit/E Visit',
-                'MAM2 Optimization+Upgrades',
-                '转子大修商机',
-                '高级产品商机',
-                '集控产品'
-            ]
-            
-            # 筛选工程师数据
-            df_engineer = df_fse[df_fse['JobTitle'].isin(engineer_titles)].copy()
-            
-            if len(df_engineer) > 0:
-                # 提取月份（日期已在Step 1中修复为正确格式）
-                df_engineer['月份'] = df_engineer['Leads Created On'].dt.to_period('M').astype(str)
-                
-                # 计算提交个数
-                submit_count = df_engineer.groupby(['八大区', '29小区', 'JobTitle', '员工名', '月份']).size().reset_index(name='提交个数')
-                
-                # 计算转化个数
-                df_engineer_converted = df_engineer[
-                    (df_engineer['Lead Status'] == 'converted') &
-                    (df_engineer['商机类型'].isin(target_opportunities))
-                ]
-                
-                convert_count = df_engineer_converted.groupby(['八大区', '29小区', 'JobTitle', '员工名', '月份']).size().reset_index(name='转化个数')
-                
-                # 合并提交和转化数据
-                df_engineer_bonus = pd.merge(submit_count, convert_count, on=['八大区', '29小区', 'JobTitle', '员工名', '月份'], how='left')
-                df_engineer_bonus['转化个数'] = df_engineer_bonus['转化个数'].fillna(0)
-                
-                # 计算当月奖金
-                df_engineer_bonus['当月奖金'] = df_engineer_bonus['提交个数'] * 20 + df_engineer_bonus['转化个数'] * 100
-                
-                # 按原始列顺序排列
-                df_engineer_bonus = df_engineer_bonus[['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金']]
-                
-                engineer_count = df_engineer_bonus['员工名'].nunique()
-                engineer_submit_total = df_engineer_bonus['提交个数'].sum()
-                engineer_convert_total = df_engineer_bonus['转化个数'].sum()
-                engineer_bonus_total = df_engineer_bonus['当月奖金'].sum()
-            else:
-                df_engineer_bonus = pd.DataFrame(columns=['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金'])
-                engineer_count = 0
-                engineer_submit_total = 0
-                engineer_convert_total = 0
-                engineer_bonus_total = 0
-            
-            status_text.text(f"✅ 工程师奖金计算完成！共 {engineer_count} 名工程师")
-            progress_bar.progress(70)
-            
-            # ==================== Step 6: 区域排名奖金计算 ====================
-            status_text.text("🏆 步骤 6/7: 正在计算区域排名奖金...")
-            progress_bar.progress(75)
-            
-            # 按29小区统计
-            df_area_stats = df_engineer_bonus.groupby('29小区').agg({
-                '提交个数': 'sum',
-                '转化个数': 'sum',
-                '当月奖金': 'sum'
-            }).reset_index()
-            
-            # 获取每个小区对应的经理
-            area_managers = df_engineer[['29小区', 'Manager']].dropna().drop_duplicates()
-            
-            # 合并经理信息
-            df_area_rank = pd.merge(df_area_stats, area_managers, on='29小区', how='left')
-            
-            # 重命名列
-            df_area_rank.columns = ['29小区', '提交总数', '转化总数', '总奖金', '经理']
-            
-            # 按总奖金排序
-            df_area_rank = df_area_rank.sort_values('总奖金', ascending=False).reset_index(drop=True)
-            
-            # 获取排名第一的小区
-            if len(df_area_rank) > 0:
-                top_area = df_area_rank.iloc[0]
-                top_area_name = top_area['29小区']
-                top_area_manager = top_area['经理']
-                top_area_bonus = top_area['总奖金']
-            else:
-                top_area_name = None
-                top_area_manager = None
-                top_area_bonus = 0
-            
-            status_text.text(f"✅ 区域排名奖金计算完成！奖金最高小区: {top_area_name}")
-            progress_bar.progress(85)
-            
-            # ==================== Step 7: 派工员奖金计算 ====================
-            status_text.text("📋 步骤 7/7: 正在计算派工员奖金...")
-            progress_bar.progress(90)
-            
-            # 定义派工员职位列表
-            planner_titles = [
-                'Planner',
-                'Senior Planner',
-                'Planning Manager',
-                'Planner - Cross Border',
-                'Service Planning Center Supervisor'
-            ]
-            
-            # 筛选派工员数据
-            df_planner = df_fse[df_fse['JobTitle'].isin(planner_titles)].copy()
-            
-            if len(df_planner) > 0:
-                # 提取月份（日期已在Step 1中修复为正确格式）
-                df_planner['月份'] = df_planner['Leads Created On'].dt.to_period('M').astype(str)
-                
-                # 灵活分组：只按JobTitle、员工名、月份分组（避免区域空值问题）
-                planner_submit = df_planner.groupby(['JobTitle', '员工名', '月份']).size().reset_index(name='提交个数')
-                
-                # 计算转化个数（与工程师相同的规则）
-                df_planner_converted = df_planner[
-                    (df_planner['Lead Status'] == 'converted') &
-                    (df_planner['商机类型'].isin(target_opportunities))
-                ]
-                
-                if len(df_planner_converted) > 0:
-                    planner_convert = df_planner_converted.groupby(['JobTitle', '员工名', '月份']).size().reset_index(name='转化个数')
-                    planner_submit = pd.merge(planner_submit, planner_convert, on=['JobTitle', '员工名', '月份'], how='left')
-                else:
-                    planner_submit['转化个数'] = 0
-                
-                planner_submit['转化个数'] = planner_submit['转化个数'].fillna(0)
-                
-                # 计算当月奖金
-                planner_submit['当月奖金'] = planner_submit['提交个数'] * 20 + planner_submit['转化个数'] * 100
-                
-                # 从原始数据中获取区域信息（保留空值）
-                area_info = df_planner[['员工名', '八大区', '29小区']].drop_duplicates()
-                df_planner_bonus = planner_submit.merge(area_info, on='员工名', how='left')
-                
-                # 重排列顺序
-                df_planner_bonus = df_planner_bonus[['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金']]
-                
-                planner_count = df_planner_bonus['员工名'].nunique()
-                planner_submit_total = df_planner_bonus['提交个数'].sum()
-                planner_convert_total = df_planner_bonus['转化个数'].sum()
-                planner_bonus_total = df_planner_bonus['当月奖金'].sum()
-            else:
-                df_planner_bonus = pd.DataFrame(columns=['八大区', '29小区', 'JobTitle', '员工名', '月份', '提交个数', '转化个数', '当月奖金'])
-                planner_count = 0
-                planner_submit_total = 0
-                planner_convert_total = 0
-                planner_bonus_total = 0
-            
-            status_text.text(f"✅ 派工员奖金计算完成！共 {planner_count} 名派工员")
-            progress_bar.progress(95)
-            
-            # ==================== 后处理奖金计算 ====================
-            status_text.text("🔧 正在计算后处理奖金...")
-            
-            # 标记包含管道过滤器的记录
-            df_fse['包含管道过滤器'] = df_fse['Lead Name'].str.contains('管道过滤器', na=False) | df_fse['Notes'].str.contains('管道过滤器', na=False)
-            
-            # 筛选包含管道过滤器的记录
-            df_pipeline = df_fse[df_fse['包含管道过滤器']].copy()
-            
-            if len(df_pipeline) > 0:
-                # 处理空八大区为"未分配"
-                df_pipeline['八大区'] = df_pipeline['八大区'].fillna('未分配')
-                
-                # 确保日期列是datetime类型
-                df_pipeline['Leads Created On'] = pd.to_datetime(df_pipeline['Leads Created On'], errors='coerce')
-                
-                # 提取月份
-                df_pipeline['月份'] = df_pipeline['Leads Created On'].dt.to_period('M').astype(str)
-                
-                # 按八大区和月份统计
-                df_pipeline_bonus = df_pipeline.groupby(['八大区', '月份']).size().reset_index(name='提交个数')
-                
-                pipeline_count = len(df_pipeline)
-                pipeline_areas = df_pipeline['八大区'].nunique()
-            else:
-                df_pipeline_bonus = pd.DataFrame(columns=['八大区', '月份', '提交个数'])
-                pipeline_count = 0
-                pipeline_areas = 0
-            
-            status_text.text(f"✅ 后处理奖金计算完成！共 {pipeline_count} 条管道过滤器记录，涉及 {pipeline_areas} 个区域")
-            progress_bar.progress(100)
-            
-            # ==================== 计算完成，显示结果 ====================
-            st.success("🎉 计算完成！所有处理步骤已完成。")
-            st.markdown("---")
-            
-            # 统计信息展示
-            st.subheader("📊 计算结果统计")
-            
-            col1, col2, col3, col4 = st.columns(4)
-            
-            with col1:
-                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                st.metric("👷 工程师人数", f"{engineer_count} 人")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            with col2:
-                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                st.metric("📋 派工员人数", f"{planner_count} 人")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            with col3:
-                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                st.metric("💰 工程师总奖金", f"¥{engineer_bonus_total:,.0f}")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            with col4:
-                st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                st.metric("💰 派工员总奖金", f"¥{planner_bonus_total:,.0f}")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            st.markdown("---")
-            
-            # 详细统计
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.markdown('<div class="info-box">', unsafe_allow_html=True)
-                st.subheader("👷 工程师奖金统计")
-                st.write(f"- **总提交数**: {engineer_submit_total} 条")
-                st.write(f"- **总转化数**: {engineer_convert_total} 条")
-                st.write(f"- **总奖金**: ¥{engineer_bonus_total:,.0f}")
-                st.write(f"- **平均奖金**: ¥{engineer_bonus_total/engineer_count:,.0f}/人" if engineer_count > 0 else "- **平均奖金**: ¥0")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            with col2:
-                st.markdown('<div class="info-box">', unsafe_allow_html=True)
-                st.subheader("📋 派工员奖金统计")
-                st.write(f"- **总提交数**: {planner_submit_total} 条")
-                st.write(f"- **总转化数**: {planner_convert_total} 条")
-                st.write(f"- **总奖金**: ¥{planner_bonus_total:,.0f}")
-                st.write(f"- **平均奖金**: ¥{planner_bonus_total/planner_count:,.0f}/人" if planner_count > 0 else "- **平均奖金**: ¥0")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            # 区域排名第一信息
-            if top_area_name:
-                st.markdown('<div class="success-box">', unsafe_allow_html=True)
-                st.subheader("🏆 区域排名第一")
-                st.write(f"- **小区名称**: {top_area_name}")
-                st.write(f"- **对应经理**: {top_area_manager}")
-                st.write(f"- **总奖金**: ¥{top_area_bonus:,.0f}")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            # 管道过滤器统计
-            if pipeline_count > 0:
-                st.markdown('<div class="info-box">', unsafe_allow_html=True)
-                st.subheader("🔧 管道过滤器统计")
-                st.write(f"- **记录总数**: {pipeline_count} 条")
-                st.write(f"- **涉及区域**: {pipeline_areas} 个")
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            st.markdown("---")
-            
-            # 结果展示标签页
-            tab1, tab2, tab3, tab4, tab5 = st.tabs([
-                "👷 工程师奖金表",
-                "📋 派工员奖金表",
-                "🏆 区域排名奖金",
-                "🔧 后处理奖金",
-                "📊 原始数据"
-            ])
-            
-            with tab1:
-                st.subheader("工程师奖金明细")
-                if len(df_engineer_bonus) > 0:
-                    st.dataframe(df_engineer_bonus, use_container_width=True, height=400)
-                    st.info(f"共 {len(df_engineer_bonus)} 条记录")
-                    
-                    # 下载按钮（使用独立的buffer）
-                    engineer_buffer = BytesIO()
-                    with pd.ExcelWriter(engineer_buffer, engine='openpyxl') as writer:
-                        df_engineer_bonus.to_excel(writer, index=False, sheet_name='工程师奖金')
-                    engineer_buffer.seek(0)
-                    
-                    st.download_button(
-                        label="📥 下载工程师奖金表",
-                        data=engineer_buffer.getvalue(),
-                        file_name="工程师奖金表.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
-                else:
-                    st.warning("暂无工程师奖金数据")
-            
-            with tab2:
-                st.subheader("派工员奖金明细")
-                if len(df_planner_bonus) > 0:
-                    st.dataframe(df_planner_bonus, use_container_width=True, height=400)
-                    st.info(f"共 {len(df_planner_bonus)} 条记录")
-                    
-                    # 下载按钮（使用独立的buffer）
-                    planner_buffer = BytesIO()
-                    with pd.ExcelWriter(planner_buffer, engine='openpyxl') as writer:
-                        df_planner_bonus.to_excel(writer, index=False, sheet_name='派工员奖金')
-                    planner_buffer.seek(0)
-                    
-                    st.download_button(
-                        label="📥 下载派工员奖金表",
-                        data=planner_buffer.getvalue(),
-                        file_name="派工员奖金表.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
-                else:
-                    st.warning("暂无派工员奖金数据")
-            
-            with tab3:
-                st.subheader("区域排名奖金明细")
-                if len(df_area_rank) > 0:
-                    st.dataframe(df_area_rank, use_container_width=True, height=400)
-                    st.info(f"共 {len(df_area_rank)} 个小区")
-                    
-                    # 下载按钮（使用独立的buffer）
-                    area_buffer = BytesIO()
-                    with pd.ExcelWriter(area_buffer, engine='openpyxl') as writer:
-                        df_area_rank.to_excel(writer, index=False, sheet_name='区域排名')
-                    area_buffer.seek(0)
-                    
-                    st.download_button(
-                        label="📥 下载区域排名奖金表",
-                        data=area_buffer.getvalue(),
-                        file_name="区域排名奖金.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
-                else:
-                    st.warning("暂无区域排名数据")
-            
-            with tab4:
-                st.subheader("后处理奖金明细")
-                if len(df_pipeline_bonus) > 0:
-                    st.dataframe(df_pipeline_bonus, use_container_width=True, height=400)
-                    st.info(f"共 {len(df_pipeline_bonus)} 条记录")
-                    
-                    # 下载按钮（使用独立的buffer）
-                    pipeline_buffer = BytesIO()
-                    with pd.ExcelWriter(pipeline_buffer, engine='openpyxl') as writer:
-                        df_pipeline_bonus.to_excel(writer, index=False, sheet_name='后处理奖金')
-                    pipeline_buffer.seek(0)
-                    
-                    st.download_button(
-                        label="📥 下载后处理奖金表",
-                        data=pipeline_buffer.getvalue(),
-                        file_name="后处理奖金.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
-                else:
-                    st.warning("暂无后处理奖金数据")
-            
-            with tab5:
-                st.subheader("处理后的原始数据")
-                # 显示新增字段
-                new_columns = ['员工名', 'JobTitle', 'Manager', '八大区', '29小区', '商机类型', '包含管道过滤器']
-                display_columns = [col for col in new_columns if col in df_fse.columns]
-                
-                if len(df_fse) > 0:
-                    st.dataframe(df_fse[display_columns].head(100), use_container_width=True, height=400)
-                    st.info(f"共显示前100条记录，总计 {len(df_fse)} 条记录")
-                    
-                    # 下载按钮（使用独立的buffer）
-                    raw_buffer = BytesIO()
-                    with pd.ExcelWriter(raw_buffer, engine='openpyxl') as writer:
-                        df_fse.to_excel(writer, index=False, sheet_name='原始数据')
-                    raw_buffer.seek(0)
-                    
-                    st.download_button(
-                        label="📥 下载完整原始数据",
-                        data=raw_buffer.getvalue(),
-                        file_name="FSE原始数据表_处理后.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
-                else:
-                    st.warning("暂无原始数据")
-            
-            st.markdown("---")
-            
-            # 一键下载所有文件
-            st.subheader("📦 一键下载所有结果")
-            
-            # 创建ZIP文件
-            zip_buffer = BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # 添加工程师奖金表
-                if len(df_engineer_bonus) > 0:
-                    excel_buffer = BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        df_engineer_bonus.to_excel(writer, index=False, sheet_name='工程师奖金')
-                    excel_buffer.seek(0)
-                    zipf.writestr("工程师奖金表.xlsx", excel_buffer.getvalue())
-                
-                # 添加派工员奖金表
-                if len(df_planner_bonus) > 0:
-                    excel_buffer = BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        df_planner_bonus.to_excel(writer, index=False, sheet_name='派工员奖金')
-                    excel_buffer.seek(0)
-                    zipf.writestr("派工员奖金表.xlsx", excel_buffer.getvalue())
-                
-                # 添加区域排名奖金表
-                if len(df_area_rank) > 0:
-                    excel_buffer = BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        df_area_rank.to_excel(writer, index=False, sheet_name='区域排名')
-                    excel_buffer.seek(0)
-                    zipf.writestr("区域排名奖金.xlsx", excel_buffer.getvalue())
-                
-                # 添加后处理奖金表
-                if len(df_pipeline_bonus) > 0:
-                    excel_buffer = BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        df_pipeline_bonus.to_excel(writer, index=False, sheet_name='后处理奖金')
-                    excel_buffer.seek(0)
-                    zipf.writestr("后处理奖金.xlsx", excel_buffer.getvalue())
-                
-                # 添加处理后的原始数据
-                excel_buffer = BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                    df_fse.to_excel(writer, index=False, sheet_name='原始数据')
-                excel_buffer.seek(0)
-                zipf.writestr("FSE原始数据表_处理后.xlsx", excel_buffer.getvalue())
-            
-            zip_buffer.seek(0)
-            
-            # 生成文件名（带日期）
-            today = datetime.now().strftime("%Y%m%d")
-            
-            st.download_button(
-                label="📦 下载所有计算结果 (ZIP)",
-                data=zip_buffer.getvalue(),
-                file_name=f"FSE奖金计算结果_{today}.zip",
-                mime="application/zip",
-                use_container_width=True
+            st.session_state['results'] = run_calculation(
+                fse_file, mapping_file, fse_header_row, mapping_header_row, current_files, progress_bar, status_text
             )
             
-            st.markdown("---")
-            st.info("💡 提示：点击上方按钮下载ZIP压缩包，包含所有生成的Excel文件。")
+            st.success("🎉 计算完成！所有处理步骤已完成。")
             
         except Exception as e:
             st.error(f"❌ 计算过程中出错: {str(e)}")
@@ -705,6 +871,230 @@ if st.button("🚀 开始计算", type="primary", use_container_width=True):
             st.error("详细错误信息:")
             st.code(traceback.format_exc())
 
+# ==================== 结果展示 ====================
+# 结果区域是独立的fragment：切换视图、筛选、生成下载文件只重新运行对应的fragment，
+# 且只加载当前视图用到的结果表
+
+
+def get_download(key):
+    """取出下载文件字节：首次请求时才生成，之后从会话存储（内存或临时文件）读取"""
+    results = st.session_state['results']
+    store = results['store']
+    store_key = 'download/all.zip' if key == 'all' else f'download/{key}.xlsx'
+    if store_key in store:
+        return store.get(store_key)
+    
+    if key == 'all':
+        # ZIP复用各结果表的工作簿
+        zip_buffer = BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for table_key, spec in RESULT_TABLES.items():
+                # 处理后的原始数据始终打包，其余结果表为空时跳过
+                if table_key == 'fse' or results['row_counts'][table_key] > 0:
+                    zipf.writestr(spec['file_name'], get_download(table_key))
+        data = zip_buffer.getvalue()
+    else:
+        data = build_excel_bytes({
+            sheet_name: store.get(f'table/{table_key}')
+            for sheet_name, table_key in RESULT_TABLES[key]['sheets'].items()
+        })
+    store.put(store_key, data)
+    return data
+
+
+def render_download_button(key, label, file_name, mime):
+    """点击“生成下载文件”后才显示下载按钮，避免每次渲染都把文件字节交给Streamlit保存在内存中"""
+    if st.button("⚙️ 生成下载文件", key=f"{key}_prepare", use_container_width=True):
+        st.download_button(
+            label=label,
+            data=get_download(key),
+            file_name=file_name,
+            mime=mime,
+            use_container_width=True,
+            key=f"{key}_download"
+        )
+
+
+def render_result_table(key):
+    """渲染单个结果表（明细、月份筛选、下载按钮）"""
+    results = st.session_state['results']
+    spec = RESULT_TABLES[key]
+    
+    st.subheader(spec['title'])
+    if results['row_counts'][key] == 0:
+        st.warning(spec['empty'])
+        return
+    
+    df = results['store'].get(f'table/{key}')
+    
+    # 月份筛选（只影响页面展示，下载文件仍为完整数据）
+    if '月份' in df.columns:
+        months = sorted(df['月份'].dropna().unique())
+        selected_months = st.multiselect("筛选月份", months, key=f"{key}_month_filter")
+        if selected_months:
+            df = df[df['月份'].isin(selected_months)]
+    
+    st.dataframe(df, use_container_width=True, height=400)
+    st.info(f"共 {len(df)} {spec['unit']}")
+    
+    if key == 'area_rank':
+        df_group = results['store'].get('table/area_group_rank')
+        st.subheader(f"按月份与八大区排名（前{AREA_TOP_K}名）")
+        st.dataframe(df_group, use_container_width=True, height=400)
+        st.info(f"共 {df_group[['月份', '八大区']].drop_duplicates().shape[0]} 个分组")
+    
+    render_download_button(
+        key,
+        spec['label'],
+        spec['file_name'],
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+
+def render_raw_data():
+    """渲染处理后的原始数据（前100条预览和完整下载）"""
+    results = st.session_state['results']
+    spec = RESULT_TABLES['fse']
+    
+    st.subheader(spec['title'])
+    if results['row_counts']['fse'] == 0:
+        st.warning(spec['empty'])
+        return
+    
+    # 显示新增字段（预览在计算时已单独保存）
+    st.dataframe(results['store'].get('table/fse_preview'), use_container_width=True, height=400)
+    st.info(f"共显示前100条记录，总计 {results['row_counts']['fse']} 条记录")
+    
+    render_download_button(
+        'fse',
+        spec['label'],
+        spec['file_name'],
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+
+@st.fragment
+def render_results():
+    """结果视图：只渲染当前选中的结果表"""
+    result_store = st.session_state['results']['store']
+    views = {spec['tab']: key for key, spec in RESULT_TABLES.items()}
+    
+    selected_view = st.radio(
+        "结果视图",
+        list(views),
+        horizontal=True,
+        key="result_view",
+        label_visibility="collapsed"
+    )
+    key = views[selected_view]
+    if key == 'fse':
+        render_raw_data()
+    else:
+        render_result_table(key)
+    
+    st.caption(
+        f"会话内存占用: {result_store.memory_usage() / 1024 / 1024:.1f} MB / {SESSION_MEMORY_BUDGET_MB:g} MB"
+        f"，{result_store.spilled_count()} 项结果已转存至临时文件"
+    )
+
+
+@st.fragment
+def render_zip_download():
+    """渲染一键下载所有结果的ZIP按钮"""
+    results = st.session_state['results']
+    
+    st.subheader("📦 一键下载所有结果")
+    render_download_button(
+        'all',
+        "📦 下载所有计算结果 (ZIP)",
+        f"FSE奖金计算结果_{results['stats']['calculated_on']}.zip",
+        "application/zip"
+    )
+
+
+if 'results' in st.session_state:
+    stats = st.session_state['results']['stats']
+    
+    st.markdown("---")
+    
+    # 统计信息展示
+    st.subheader("📊 计算结果统计")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+        st.metric("👷 工程师人数", f"{stats['engineer_count']} 人")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    with col2:
+        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+        st.metric("📋 派工员人数", f"{stats['planner_count']} 人")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    with col3:
+        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+        st.metric("💰 工程师总奖金", f"¥{stats['engineer_bonus_total']:,.0f}")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    with col4:
+        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+        st.metric("💰 派工员总奖金", f"¥{stats['planner_bonus_total']:,.0f}")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    st.markdown("---")
+    
+    # 详细统计
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.markdown('<div class="info-box">', unsafe_allow_html=True)
+        st.subheader("👷 工程师奖金统计")
+        st.write(f"- **总提交数**: {stats['engineer_submit_total']} 条")
+        st.write(f"- **总转化数**: {stats['engineer_convert_total']} 条")
+        st.write(f"- **总奖金**: ¥{stats['engineer_bonus_total']:,.0f}")
+        st.write(f"- **平均奖金**: ¥{stats['engineer_bonus_total']/stats['engineer_count']:,.0f}/人" if stats['engineer_count'] > 0 else "- **平均奖金**: ¥0")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    with col2:
+        st.markdown('<div class="info-box">', unsafe_allow_html=True)
+        st.subheader("📋 派工员奖金统计")
+        st.write(f"- **总提交数**: {stats['planner_submit_total']} 条")
+        st.write(f"- **总转化数**: {stats['planner_convert_total']} 条")
+        st.write(f"- **总奖金**: ¥{stats['planner_bonus_total']:,.0f}")
+        st.write(f"- **平均奖金**: ¥{stats['planner_bonus_total']/stats['planner_count']:,.0f}/人" if stats['planner_count'] > 0 else "- **平均奖金**: ¥0")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    # 区域排名第一信息
+    if stats['top_area_name']:
+        st.markdown('<div class="success-box">', unsafe_allow_html=True)
+        st.subheader("🏆 区域排名第一")
+        st.write(f"- **小区名称**: {stats['top_area_name']}")
+        st.write(f"- **对应经理**: {stats['top_area_manager']}")
+        st.write(f"- **总奖金**: ¥{stats['top_area_bonus']:,.0f}")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    # 管道过滤器统计
+    if stats['pipeline_count'] > 0:
+        st.markdown('<div class="info-box">', unsafe_allow_html=True)
+        st.subheader("🔧 管道过滤器统计")
+        st.write(f"- **记录总数**: {stats['pipeline_count']} 条")
+        st.write(f"- **涉及区域**: {stats['pipeline_areas']} 个")
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    st.markdown("---")
+    
+    # 结果展示（只渲染当前选中的结果表）
+    render_results()
+    
+    st.markdown("---")
+    
+    # 一键下载所有文件
+    render_zip_download()
+    
+    st.markdown("---")
+    st.info("💡 提示：点击“生成下载文件”后再点击下载按钮，ZIP压缩包包含所有生成的Excel文件。")
+
 # 底部说明
 st.markdown("---")
 st.markdown("""
@@ -716,8 +1106,9 @@ st.markdown("""
 - ✅ 精准识别商机类型
 - ✅ 工程师奖金计算（按月份统计）
 - ✅ 派工员奖金计算（按月份统计）
-- ✅ 区域排名奖金统计
+- ✅ 区域排名奖金统计（含按月份与八大区分组排名）
 - ✅ 后处理奖金计算（管道过滤器）
+- ✅ 表头预检（缺失列快速提示并推荐相近列名）
 - ✅ 实时显示处理进度
 - ✅ 交互式数据展示
 - ✅ 一键下载所有结果